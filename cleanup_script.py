@@ -1,6 +1,5 @@
 import json
-import os
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta
 
 def fix_time_string(t_str):
     if not isinstance(t_str, str): 
@@ -31,25 +30,24 @@ def process_dict(d):
 
 def run_fixer():
     files_to_fix = [
-        "run_history.json", "state.json",
+        "state.json",
         "active_notams_raw.json", "active_notams_decoded.json", "active_notams_ai_decoded.json",
         "expired_notams_raw.json", "expired_notams_decoded.json", "expired_notams_ai_decoded.json",
         "plane_history.json", "plane_archive.json"
     ]
 
     for file in files_to_fix:
-        if os.path.exists(file):
+        try:
             with open(file, "r", encoding="utf-8") as f:
-                try:
-                    data = json.load(f)
-                except json.JSONDecodeError:
-                    continue
-            
-            process_dict(data)
-            
-            with open(file, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=2)
-            print(f"Successfully fixed time formatting in {file}")
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            continue
+        
+        process_dict(data)
+        
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        print(f"Successfully fixed time formatting in {file}")
 
 if __name__ == "__main__":
     run_fixer()
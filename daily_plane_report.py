@@ -23,12 +23,10 @@ MAX_ROUTE_LOOKUPS = int(os.environ.get("MAX_ROUTE_LOOKUPS", "40"))
 
 
 def load_json(path: Path, default: Any) -> Any:
-    if not path.exists():
-        return default
     try:
         with path.open("r", encoding="utf-8") as f:
             return json.load(f)
-    except Exception:
+    except (FileNotFoundError, ValueError):
         return default
 
 
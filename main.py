@@ -3,22 +3,36 @@ import json
 import os
 import sys
 import time
-import subprocess
-import tempfile
 import re
+import threading
+import hashlib
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timezone, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from shapely.geometry import Point, shape
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 URL = "https://notams.aim.faa.gov/notamSearch/search"
+FAA_BASE_PAYLOAD = {"searchType": 0, "notamsOnly": False, "radius": 10}
 STATE_FILE = "state.json"
-HISTORY_FILE = "run_history.json"
+HISTORY_FILE = "run_history.jsonl"
+HISTORY_MAX_BYTES = 50_000
 AI_BUFFER_FILE = "ai_buffer.json"
 
 PLANE_STATE_FILE = "plane_state.json"
 PLANE_HISTORY_FILE = "plane_history.json"
 PLANE_ARCHIVE_FILE = "plane_archive.json"
 ICAO_AIRLINES_FILE = "icao_airlines.json"
+DECODER_SCRIPT = "wrapper.js"
+FR24_META_KEYS = {"full_count", "version", "stats"}
+RAW_NOTAM_FIELDS = ("facilityDesignator", "notamNumber", "icaoId", "icaoMessage", "featureName", "airportName", "issueDate", "startDate", "endDate", "status", "keyword", "cancelledOrExpired")
 
 ACTIVE_RAW_FILE = "active_notams_raw.json"
 ACTIVE_DECODED_FILE = "active_notams_decoded.json"
@@ -35,6 +49,18 @@ if not TELEGRAM_TOKEN or not CHAT_ID:
     print("Error: Telegram secrets are missing.")
     sys.exit(1)
 
+TELEGRAM_SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+TELEGRAM_BASE_PAYLOAD = {"chat_id": CHAT_ID, "parse_mode": "Markdown", "disable_web_page_preview": True}
+TELEGRAM_HEADERS = {"Content-Type": "application/json"}
+
+# Telegram allows roughly 20 messages per minute into a single chat
+TELEGRAM_RATE_LIMIT = 20
+TELEGRAM_RATE_WINDOW = 60.0
+telegram_send_times = deque(maxlen=TELEGRAM_RATE_LIMIT)
+TELEGRAM_PACK_THRESHOLD = 5
+MAX_TELEGRAM_CHARS = 3800
+IMPORTANCE_LABELS = {"First Level": "1️⃣ First", "Second Level": "2️⃣ Second", "Third Level": "3️⃣ Third"}
+
 API_KEYS = [
     os.environ.get("GEMINI_API_KEY_F92"),
     os.environ.get("GEMINI_API_KEY_F1"),
@@ -46,6 +72,17 @@ API_KEYS = [
 ]
 
 ACTIVE_KEYS = deque([k for k in API_KEYS if k and k.strip()])
+ai_keys_lock = threading.Lock()
+AI_KEY_INTERVAL = 3.0
+ai_key_next_ok = {}
+
+decoder_process = None
+
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "Mozilla/5.0"})
+HTTP_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.5, backoff_max=5, status_forcelist=[500, 502, 503, 504], respect_retry_after_header=False, raise_on_status=False))
+SESSION.mount("https://", HTTP_ADAPTER)
+SESSION.mount("http://", HTTP_ADAPTER)
 
 ICAO_DICT = {
     "ACFT": "Aircraft", "AD": "Aerodrome", "ALTN": "Alternate", "AMSL": "Above Mean Sea Level",
@@ -76,25 +113,40 @@ ICAO_DICT = {
     "WI": "Within", "WIP": "Work In Progress", "WX": "Weather"
 }
 
-tehran_tz = timezone(timedelta(hours=3, minutes=30))
-
+IRAN_NAME_PATTERNS = [
+    re.compile(r'islamic\s+republic\s+of\s+iran', re.IGNORECASE),
+    re.compile(r'iran\s+\(islamic\s+republic\s+of\)', re.IGNORECASE),
+    re.compile(r'islamic\s+republic\s+iran', re.IGNORECASE)
+]
+TABLE_ROW_RE = re.compile(r'<tr[^>]*>', re.IGNORECASE)
+TABLE_CELL_RE = re.compile(r'<td[^>]*>(.*?)</td>', re.IGNORECASE | re.DOTALL)
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+VALID_FROM_RE = re.compile(r'B\)\s*(\d{10})')
+VALID_TO_RE = re.compile(r'C\)\s*(\d{10}|PERM)(.*?)(\n|D\)|E\)|F\)|G\))')
+PAREN_NOTE_RE = re.compile(r'\s*\(.*?\)')
+# Longest first so no abbreviation is shadowed by a shorter prefix
+ICAO_ABBR_RE = re.compile(r'\b(' + '|'.join(sorted(map(re.escape, ICAO_DICT), key=len, reverse=True)) + r')\b')
+
+TEHRAN_OFFSET = timedelta(hours=3, minutes=30)
+tehran_tz = timezone(TEHRAN_OFFSET)
+
+@lru_cache(maxsize=4096)
 def parse_and_convert_time(time_str):
     if len(time_str) >= 10 and time_str[:10].isdigit():
-        y = int("20" + time_str[0:2])
-        m = int(time_str[2:4])
-        d = int(time_str[4:6])
-        h = int(time_str[6:8])
-        minute = int(time_str[8:10])
+        n, minute = divmod(int(time_str[:10]), 100)
+        n, h = divmod(n, 100)
+        n, d = divmod(n, 100)
+        y, m = divmod(n, 100)
+        y += 2000
         try:
             dt_utc = datetime(y, m, d, h, minute, tzinfo=timezone.utc)
-            dt_teh = dt_utc.astimezone(tehran_tz)
+            dt_teh = (dt_utc + TEHRAN_OFFSET).replace(tzinfo=tehran_tz)
             return dt_utc, dt_teh
         except ValueError:
             return None, None
     return None, None
 
-def get_relative_string(dt_utc):
-    now = datetime.now(timezone.utc)
+def get_relative_string(dt_utc, now):
     diff = dt_utc - now
     secs = diff.total_seconds()
     future = secs > 0
@@ -112,30 +164,57 @@ def get_relative_string(dt_utc):
 def translate_e_section(text):
     e_section = text
     if "E)" in text:
-        parts = text.split("E)")
-        raw_e = parts[1]
-        if "F)" in raw_e: raw_e = raw_e.split("F)")[0]
-        elif "G)" in raw_e: raw_e = raw_e.split("G)")[0]
+        raw_e = text.partition("E)")[2].partition("E)")[0]
+        if "F)" in raw_e: raw_e = raw_e.partition("F)")[0]
+        elif "G)" in raw_e: raw_e = raw_e.partition("G)")[0]
         e_section = raw_e.strip()
-    for abbr, full in ICAO_DICT.items():
-        e_section = re.sub(rf'\b{abbr}\b', full, e_section)
-    return e_section
+    return ICAO_ABBR_RE.sub(lambda m: ICAO_DICT[m.group(1)], e_section)
 
-def load_json(filepath, default_value):
-    if not os.path.exists(filepath): return default_value
-    with open(filepath, "r", encoding="utf-8") as f:
-        try: return json.load(f)
-        except: return default_value
+file_digests = {}
 
-def save_json(filepath, data):
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+def file_digest(raw):
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+def parse_json(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def load_json(filepath, default_value):
+    try:
+        with open(filepath, "rb") as f: raw = f.read()
+    except FileNotFoundError: return default_value
+    file_digests[filepath] = file_digest(raw)
+    try: return parse_json(raw)
+    except ValueError: return default_value
+
+def save_json(filepath, data, compact=False):
+    if orjson: raw = orjson.dumps(data, option=0 if compact else orjson.OPT_INDENT_2)
+    elif compact: raw = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    else: raw = json.dumps(data, indent=2).encode("utf-8")
+    digest = file_digest(raw)
+    if file_digests.get(filepath) == digest: return
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+    file_digests[filepath] = digest
+
+def append_run_history(run_record):
+    line = (orjson.dumps(run_record) if orjson else json.dumps(run_record, separators=(",", ":")).encode("utf-8")) + b"\n"
+    with open(HISTORY_FILE, "ab") as f:
+        f.write(line)
+        history_size = f.tell()
+    if history_size > HISTORY_MAX_BYTES:
+        with open(HISTORY_FILE, "rb") as f: recent_lines = deque(f, maxlen=250)
+        tmp_path = HISTORY_FILE + ".tmp"
+        with open(tmp_path, "wb") as f: f.writelines(recent_lines)
+        os.replace(tmp_path, HISTORY_FILE)
 
 def clean_iran_name(text):
     if not text: return text
-    cleaned = re.sub(r'islamic\s+republic\s+of\s+iran', 'IRAN', text, flags=re.IGNORECASE)
-    cleaned = re.sub(r'iran\s+\(islamic\s+republic\s+of\)', 'IRAN', cleaned, flags=re.IGNORECASE)
-    cleaned = re.sub(r'islamic\s+republic\s+iran', 'IRAN', cleaned, flags=re.IGNORECASE)
+    cleaned = text
+    for pattern in IRAN_NAME_PATTERNS: cleaned = pattern.sub('IRAN', cleaned)
     if cleaned.strip().lower() == 'iran':
         return 'IRAN'
     return cleaned
@@ -147,19 +226,18 @@ def update_faa_registry():
     if now - last_check < 86400 and len(airlines_data) > 1:
         return airlines_data
     print("Updating FAA ICAO Airline registry no AI calls here...")
-    headers = {"User-Agent": "Mozilla/5.0"}
     url = "https://www.faa.gov/air_traffic/publications/atpubs/cnt_html/chap3_section_3.html"
     try:
-        resp = requests.get(url, headers=headers, timeout=20)
+        resp = SESSION.get(url, timeout=20)
         resp.raise_for_status()
         html_content = resp.text
-        rows = re.split(r'<tr[^>]*>', html_content, flags=re.IGNORECASE)[1:]
+        rows = TABLE_ROW_RE.split(html_content)[1:]
         for row in rows:
-            cols = re.findall(r'<td[^>]*>(.*?)</td>', row, flags=re.IGNORECASE | re.DOTALL)
+            cols = TABLE_CELL_RE.findall(row)
             if len(cols) >= 3:
-                code = re.sub(r'<[^>]+>', '', cols[0]).strip()
-                company = re.sub(r'<[^>]+>', '', cols[1]).strip()
-                country = re.sub(r'<[^>]+>', '', cols[2]).strip().title()
+                code = HTML_TAG_RE.sub('', cols[0]).strip()
+                company = HTML_TAG_RE.sub('', cols[1]).strip()
+                country = HTML_TAG_RE.sub('', cols[2]).strip().title()
                 country = clean_iran_name(country)
                 if len(code) == 3 and code.isalpha():
                     if code not in airlines_data:
@@ -173,8 +251,25 @@ def update_faa_registry():
     save_json(ICAO_AIRLINES_FILE, airlines_data)
     return airlines_data
 
+def strip_code_fence(text):
+    return text.removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+
+def next_ai_key():
+    with ai_keys_lock:
+        if not ACTIVE_KEYS: return None
+        ACTIVE_KEYS.rotate(-1)
+        key = ACTIVE_KEYS[-1]
+        now = time.monotonic()
+        ready_at = max(ai_key_next_ok.get(key, 0.0), now)
+        ai_key_next_ok[key] = ready_at + AI_KEY_INTERVAL
+    if ready_at > now: time.sleep(ready_at - now)
+    return key
+
+def drop_ai_key(key):
+    with ai_keys_lock:
+        if key in ACTIVE_KEYS: ACTIVE_KEYS.remove(key)
+
 def translate_active_airlines(active_codes, airlines_data):
-    global ACTIVE_KEYS
     to_translate = {}
     for code in active_codes:
         info = airlines_data.get(code)
@@ -187,33 +282,28 @@ def translate_active_airlines(active_codes, airlines_data):
     keys_tried = 0
     initial_key_count = len(ACTIVE_KEYS)
     success = False
-    while keys_tried < initial_key_count and ACTIVE_KEYS and not success:
-        current_key = ACTIVE_KEYS.popleft()
-        ACTIVE_KEYS.append(current_key)
+    while keys_tried < initial_key_count and not success:
+        current_key = next_ai_key()
+        if not current_key: break
         keys_tried += 1
         try:
             ai_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={current_key}"
-            resp = requests.post(ai_url, headers={'Content-Type': 'application/json'}, json=data, timeout=20)
+            resp = SESSION.post(ai_url, headers={'Content-Type': 'application/json'}, json=data, timeout=20)
             if resp.status_code == 429:
-                ACTIVE_KEYS.pop()
+                drop_ai_key(current_key)
                 continue
             resp.raise_for_status()
-            text = resp.json()['candidates'][0]['content']['parts'][0]['text'].strip()
-            if text.startswith("```json"): text = text[7:-3]
-            elif text.startswith("```"): text = text[3:-3]
-            common_names = json.loads(text.strip())
+            text = parse_json(resp.content)['candidates'][0]['content']['parts'][0]['text'].strip()
+            common_names = parse_json(strip_code_fence(text))
             for c, common in common_names.items():
                 if c in airlines_data: airlines_data[c]["common_name"] = common
             success = True
             save_json(ICAO_AIRLINES_FILE, airlines_data)
-            time.sleep(3)
-        except Exception as e:
-            if "429" in str(e): ACTIVE_KEYS.pop()
+        except Exception:
             continue
     return airlines_data
 
 def get_ai_explanation(raw_text):
-    global ACTIVE_KEYS
     if not ACTIVE_KEYS: return None
     models = ["gemini-2.5-flash", "gemini-2.0-flash"]
     headers = {'Content-Type': 'application/json'}
@@ -221,87 +311,169 @@ def get_ai_explanation(raw_text):
     data = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": {"response_mime_type": "application/json", "temperature": 0.2}}
     keys_tried = 0
     initial_key_count = len(ACTIVE_KEYS)
-    while keys_tried < initial_key_count and ACTIVE_KEYS:
-        current_key = ACTIVE_KEYS.popleft()
-        ACTIVE_KEYS.append(current_key)
+    while keys_tried < initial_key_count:
+        current_key = next_ai_key()
+        if not current_key: break
         keys_tried += 1
         key_failed_429 = False
         for model in models:
             url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={current_key}"
             try:
-                response = requests.post(url, headers=headers, json=data, timeout=30)
+                response = SESSION.post(url, headers=headers, json=data, timeout=30)
                 if response.status_code == 404: continue
                 if response.status_code == 429:
                     key_failed_429 = True
                     break
                 response.raise_for_status()
-                res_json = response.json()
+                res_json = parse_json(response.content)
                 text = res_json['candidates'][0]['content']['parts'][0]['text'].strip()
-                if text.startswith("```json"): text = text[7:-3]
-                elif text.startswith("```"): text = text[3:-3]
-                time.sleep(3)
-                return json.loads(text.strip())
-            except Exception as e:
-                if "429" in str(e): key_failed_429 = True
+                return parse_json(strip_code_fence(text))
+            except Exception:
                 break
-        if key_failed_429: ACTIVE_KEYS.pop()
-    time.sleep(3)
+        if key_failed_429: drop_ai_key(current_key)
     return None
 
-def send_telegram(message):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    payload = {"chat_id": CHAT_ID, "text": message, "parse_mode": "Markdown", "disable_web_page_preview": True}
-    try: requests.post(url, json=payload, timeout=10)
-    except: pass
+def get_ai_explanations(raw_texts):
+    if not raw_texts or not ACTIVE_KEYS: return [None] * len(raw_texts)
+    with ThreadPoolExecutor(max_workers=min(len(raw_texts), len(ACTIVE_KEYS), 4)) as executor:
+        return list(executor.map(get_ai_explanation, raw_texts))
+
+def wait_for_telegram_slot():
+    now = time.monotonic()
+    if len(telegram_send_times) == TELEGRAM_RATE_LIMIT:
+        wait = TELEGRAM_RATE_WINDOW - (now - telegram_send_times[0])
+        if wait > 0:
+            time.sleep(wait)
+            now = time.monotonic()
+    telegram_send_times.append(now)
+
+def send_telegram(message, plain=False):
+    payload = {**TELEGRAM_BASE_PAYLOAD, "text": message}
+    if plain: del payload["parse_mode"]
+    body = orjson.dumps(payload) if orjson else json.dumps(payload).encode("utf-8")
+    for attempt in range(2):
+        wait_for_telegram_slot()
+        try: response = SESSION.post(TELEGRAM_SEND_URL, data=body, headers=TELEGRAM_HEADERS, timeout=10)
+        except Exception: return False
+        if response.status_code != 429 or attempt:
+            # Any other 4xx is a permanent refusal of this text
+            if 400 <= response.status_code < 500 and response.status_code != 429: return None
+            return response.ok
+        try: retry_after = parse_json(response.content).get("parameters", {}).get("retry_after", 1)
+        except ValueError: retry_after = 1
+        time.sleep(retry_after + 0.5)
+    return False
+
+def send_telegram_pack(items, text):
+    result = send_telegram(text)
+    if result is not None: return [result] * len(items)
+    if len(items) > 1: return [send_telegram_pack([item], item[1])[0] for item in items]
+    return [send_telegram(text, plain=True) is not False]
+
+def pack_telegram_messages(outbox):
+    if len(outbox) <= TELEGRAM_PACK_THRESHOLD: return [([item], item[1]) for item in outbox]
+    packed = []
+    items, current = [], ""
+    for item in outbox:
+        msg = item[1]
+        if current and len(current) + len(msg) + 2 > MAX_TELEGRAM_CHARS:
+            packed.append((items, current))
+            items, current = [], ""
+        items.append(item)
+        current = f"{current}\n\n{msg}" if current else msg
+    if current: packed.append((items, current))
+    return packed
+
+def get_decoder():
+    global decoder_process
+    if decoder_process is None or decoder_process.poll() is not None:
+        import subprocess
+        decoder_process = subprocess.Popen(['node', DECODER_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return decoder_process
+
+def stop_decoder():
+    global decoder_process
+    if decoder_process is None: return
+    try:
+        decoder_process.stdin.close()
+        decoder_process.wait(timeout=10)
+    except Exception:
+        decoder_process.kill()
+    decoder_process = None
 
-def decode_notam(raw_text):
-    fd_in, temp_path_in = tempfile.mkstemp(text=True)
-    fd_out, temp_path_out = tempfile.mkstemp(text=True)
-    os.close(fd_in)
-    os.close(fd_out)
+def raw_text_digest(raw_text):
+    return hashlib.blake2b(raw_text.encode("utf-8"), digest_size=8).hexdigest()
+
+def decode_notams(raw_texts):
+    if not raw_texts: return []
     try:
-        with open(temp_path_in, 'w', encoding='utf-8') as f: f.write(raw_text)
-        js_code = """const fs = require('fs'); try { const notamDecoder = require('./notam-decoder.js'); const raw = fs.readFileSync(process.argv[1], 'utf8'); const decoded = notamDecoder.decode(raw); fs.writeFileSync(process.argv[2], JSON.stringify(decoded || {error: "Empty result"}), 'utf8'); } catch(e) { fs.writeFileSync(process.argv[2], JSON.stringify({error: e.toString()}), 'utf8'); }"""
-        process = subprocess.run(['node', '-e', js_code, temp_path_in, temp_path_out], capture_output=True, text=True)
-        with open(temp_path_out, 'r', encoding='utf-8') as f: output_data = f.read()
-        if not output_data.strip(): return {"error": "Empty output"}
-        return json.loads(output_data)
+        process = get_decoder()
+        process.stdin.write((orjson.dumps(raw_texts) if orjson else json.dumps(raw_texts).encode("utf-8")) + b"\n")
+        process.stdin.flush()
+        output_data = process.stdout.readline()
+        if not output_data.strip(): return [{"error": "Empty output"} for _ in raw_texts]
+        decoded = parse_json(output_data)
+        if not isinstance(decoded, list) or len(decoded) != len(raw_texts): return [{"error": "Mismatched batch output"} for _ in raw_texts]
+        return decoded
     except Exception as e:
-        return {"error": f"PYTHON CRASH: {str(e)}"}
-    finally:
-        if os.path.exists(temp_path_in): os.remove(temp_path_in)
-        if os.path.exists(temp_path_out): os.remove(temp_path_out)
+        return [{"error": f"PYTHON CRASH: {str(e)}"} for _ in raw_texts]
+
+def fetch_notam_page(target, offset):
+    payload = {**FAA_BASE_PAYLOAD, "designatorsForLocation": target, "offset": offset}
+    try:
+        response = SESSION.post(URL, data=payload, timeout=30)
+        response.raise_for_status()
+        data = parse_json(response.content)
+    except Exception:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("notamList"), list): return None
+    return data
+
+def fetch_notam_pages(target):
+    batch_size = 30
+    window = 4
+    first_page = fetch_notam_page(target, 0)
+    if not first_page: return None
+    notams = first_page["notamList"]
+    if len(notams) < batch_size: return notams
+    total = first_page.get("totalNotamCount")
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        if isinstance(total, int):
+            offsets = range(batch_size, total, batch_size)
+            for page in executor.map(fetch_notam_page, [target] * len(offsets), offsets):
+                if not page: return None
+                notams.extend(page["notamList"])
+            return notams if len(notams) >= total else None
+        offset = len(notams)
+        while True:
+            offsets = [offset + i * batch_size for i in range(window)]
+            for page in executor.map(fetch_notam_page, [target] * window, offsets):
+                if not page: return None
+                if not page["notamList"]: return notams
+                notams.extend(page["notamList"])
+                if len(page["notamList"]) < batch_size: return notams
+            offset += window * batch_size
 
 def get_all_notams():
-    headers = {"User-Agent": "Mozilla/5.0"}
-    all_notams = []
     targets = ["OIIX", "KICZ"]
-    for target in targets:
-        offset = 0
-        batch_size = 30
-        while True:
-            payload = {"searchType": 0, "designatorsForLocation": target, "offset": offset, "notamsOnly": False, "radius": 10}
-            try:
-                response = requests.post(URL, data=payload, headers=headers, timeout=30)
-                response.raise_for_status()
-                data = response.json()
-                if not data or "notamList" not in data: break
-                current_batch = data["notamList"]
-                if not current_batch: break
-                if target == "KICZ":
-                    for n in current_batch:
-                        msg_text = (n.get("icaoMessage") or "").upper()
-                        if "IRAN" in msg_text or "OIIX" in msg_text or "TEHRAN" in msg_text: all_notams.append(n)
-                else:
-                    all_notams.extend(current_batch)
-                offset += len(current_batch)
-                if len(current_batch) < batch_size: break
-                time.sleep(1)
-            except Exception as e:
-                break
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        batches = dict(zip(targets, executor.map(fetch_notam_pages, targets)))
+    if None in batches.values(): return []
+    all_notams = batches["OIIX"]
+    for n in batches["KICZ"]:
+        msg_text = (n.get("icaoMessage") or "").upper()
+        if "IRAN" in msg_text or "OIIX" in msg_text or "TEHRAN" in msg_text: all_notams.append(n)
     return all_notams
 
-def extract_notam_details(raw_text, decoded_obj, notam_id):
+def classify_geometry(coords, area):
+    if isinstance(area, list) and len(area) > 2: return "polygon"
+    if isinstance(coords, list) and len(coords) >= 2:
+        # Q) centres decode as [[lat, lng], {"radius": nm}], plain points as [lat, lng]
+        if isinstance(coords[0], list): return "circle" if len(coords) == 2 else None
+        if isinstance(coords[0], (int, float)): return "point"
+    return None
+
+def extract_notam_details(raw_text, decoded_obj, notam_id, now):
     subject_text = "Unknown Subject"
     condition_text = "Unknown Condition"
     notam_type = "New NOTAM"
@@ -310,13 +482,13 @@ def extract_notam_details(raw_text, decoded_obj, notam_id):
     valid_from_str = "Unknown"
     valid_to_str = "Unknown"
     
-    b_match = re.search(r'B\)\s*(\d{10})', raw_text)
-    c_match = re.search(r'C\)\s*(\d{10}|PERM)(.*?)(\n|D\)|E\)|F\)|G\))', raw_text)
+    b_match = VALID_FROM_RE.search(raw_text) if "B)" in raw_text else None
+    c_match = VALID_TO_RE.search(raw_text) if "C)" in raw_text else None
     if b_match:
         dt_utc, dt_teh = parse_and_convert_time(b_match.group(1))
         if dt_utc:
-            rel = get_relative_string(dt_utc)
-            status = "Started" if (dt_utc < datetime.now(timezone.utc)) else "Starts in"
+            rel = get_relative_string(dt_utc, now)
+            status = "Started" if (dt_utc < now) else "Starts in"
             valid_from_str = f"{dt_teh.strftime('%Y/%m/%d %H:%M')} Tehran Time ({status if 'in' in rel else 'Started'} {rel.replace('in ', '')})"
     if c_match:
         val_c = c_match.group(1)
@@ -324,8 +496,8 @@ def extract_notam_details(raw_text, decoded_obj, notam_id):
         else:
             dt_utc, dt_teh = parse_and_convert_time(val_c)
             if dt_utc:
-                rel = get_relative_string(dt_utc)
-                status = "Expired" if (dt_utc < datetime.now(timezone.utc)) else "Expires in"
+                rel = get_relative_string(dt_utc, now)
+                status = "Expired" if (dt_utc < now) else "Expires in"
                 est_tag = " (Estimated)" if "EST" in c_match.group(2) else ""
                 valid_to_str = f"{dt_teh.strftime('%Y/%m/%d %H:%M')} Tehran Time ({status if 'in' in rel else 'Expired'} {rel.replace('in ', '')}){est_tag}"
 
@@ -341,19 +513,26 @@ def extract_notam_details(raw_text, decoded_obj, notam_id):
             if isinstance(code_block, dict):
                 subject_text = code_block.get("subject", subject_text)
                 condition_text = code_block.get("modifier", condition_text)
-            coords = qual_block.get("coordinates")
-            content_block = decoded_obj.get("content", {})
-            area = content_block.get("area")
-            has_map = False
-            if area and isinstance(area, list) and len(area) > 2: has_map = True
-            elif coords and isinstance(coords, list) and len(coords) == 2 and isinstance(coords[0], list): has_map = True
-            elif coords and isinstance(coords, list) and len(coords) >= 2 and isinstance(coords[0], (int, float)): has_map = True
-            if has_map: map_links.append(f"🗺️ [Click to View Area on Map](https://raw.githack.com/freddishio/oiix-notam-watcher/main/index.html#{notam_id})")
-
-    subject_text = re.sub(r'\s*\(.*?\)', '', subject_text).strip()
-    condition_text = re.sub(r'\s*\(.*?\)', '', condition_text).strip()
+            area = decoded_obj.get("content", {}).get("area")
+            if classify_geometry(qual_block.get("coordinates"), area): map_links.append(f"🗺️ [Click to View Area on Map](https://raw.githack.com/freddishio/oiix-notam-watcher/main/index.html#{notam_id})")
+
+    if "(" in subject_text: subject_text = PAREN_NOTE_RE.sub('', subject_text)
+    if "(" in condition_text: condition_text = PAREN_NOTE_RE.sub('', condition_text)
+    subject_text = subject_text.strip()
+    condition_text = condition_text.strip()
     return notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links
 
+def fetch_fr24_quadrant(bounds):
+    headers = {"Accept": "application/json", "Referer": "https://www.flightradar24.com/"}
+    fr24_url = f"https://data-cloud.flightradar24.com/zones/fcgi/feed.js?bounds={bounds}&estimated=1"
+    try:
+        response = SESSION.get(fr24_url, headers=headers, timeout=15)
+        response.raise_for_status()
+        data = parse_json(response.content)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
 def fetch_iran_planes():
     print("Fetching active aircraft locations over 16 high resolution quadrants from Flightradar24...")
     bounds_list = [
@@ -369,25 +548,18 @@ def fetch_iran_planes():
         lon = float(parts[1])
         api_bounds.append(f"{lat+2.5:.2f},{lat-2.5:.2f},{lon-3.2:.2f},{lon+3.2:.2f}")
     
-    headers = {"User-Agent": "Mozilla/5.0", "Accept": "application/json", "Referer": "https://www.flightradar24.com/"}
     all_fr24_data = {}
-    for b in api_bounds:
-        fr24_url = f"https://data-cloud.flightradar24.com/zones/fcgi/feed.js?bounds={b}&estimated=1"
-        try:
-            response = requests.get(fr24_url, headers=headers, timeout=15)
-            response.raise_for_status()
-            data = response.json()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for data in executor.map(fetch_fr24_quadrant, api_bounds):
             for key, value in data.items():
-                if key not in ["full_count", "version", "stats"]: all_fr24_data[key] = value
-        except Exception as e:
-            pass
+                if key not in FR24_META_KEYS: all_fr24_data[key] = value
 
     geo_url = "https://raw.githubusercontent.com/vatsimnetwork/vatspy-data-project/master/Boundaries.geojson"
     oiix_polygon = None
     try:
-        geo_resp = requests.get(geo_url, timeout=15)
+        geo_resp = SESSION.get(geo_url, timeout=15)
         geo_resp.raise_for_status()
-        geo_data = geo_resp.json()
+        geo_data = parse_json(geo_resp.content)
         for feature in geo_data.get("features", []):
             props = feature.get("properties", {})
             if props.get("id") == "OIIX" or "Tehran" in props.get("FIRname", ""):
@@ -440,7 +612,7 @@ def fetch_iran_planes():
 
 
 def generate_planes_html(history_rendered):
-    json_data_string = json.dumps(history_rendered).replace("</", "<\\/")
+    json_data_string = (orjson.dumps(history_rendered).decode("utf-8") if orjson else json.dumps(history_rendered)).replace("</", "<\\/")
     html = r"""<!DOCTYPE html>
 <html lang="en">
 <head>
@@ -2205,14 +2377,12 @@ def generate_planes_html(history_rendered):
 
 
 def format_telegram_message(notam_id, notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links, pyramid_levels, ai_explanation, raw_text, is_update=False):
-    importance_str = "⏳ Pending"
-    if "First" in pyramid_levels: importance_str = "1️⃣ First"
-    elif "Second" in pyramid_levels: importance_str = "2️⃣ Second"
-    elif "Third" in pyramid_levels: importance_str = "3️⃣ Third"
+    importance_str = IMPORTANCE_LABELS.get(pyramid_levels)
+    if importance_str is None: importance_str = next((label for level, label in IMPORTANCE_LABELS.items() if level.split()[0] in pyramid_levels), "⏳ Pending")
 
     msg_parts = []
     if is_update: msg_parts.append("⚠️ *This NOTAM is not new and has been sent before. The bot is sending it again because the AI explanation has now been provided.*")
-    msg_parts.append(f"🚀 **TEHRAN FIR NOTAM ALERT (OIIX)**")
+    msg_parts.append("🚀 **TEHRAN FIR NOTAM ALERT (OIIX)**")
     msg_parts.append(f"NOTAM Number: {notam_id} • {notam_type}")
     msg_parts.append(f"🚨 Importance level: {importance_str}")
     msg_parts.append("------------------------------------")
@@ -2234,8 +2404,7 @@ def format_telegram_message(notam_id, notam_type, valid_from_str, valid_to_str,
 def main():
     print("Fetching FULL data from FAA AIM OIIX Only...")
     seen_ids = load_json(STATE_FILE, {})
-    run_history = load_json(HISTORY_FILE, [])
-    ai_buffer = load_json(AI_BUFFER_FILE, [])
+    ai_buffer = set(load_json(AI_BUFFER_FILE, []))
     
     active_notams_raw = load_json(ACTIVE_RAW_FILE, {})
     active_notams_decoded = load_json(ACTIVE_DECODED_FILE, {})
@@ -2250,9 +2419,11 @@ def main():
     if "airspace_status" not in plane_state:
         plane_state["airspace_status"] = "CLOSED"
 
-    notam_list = get_all_notams()
-    
-    current_planes = fetch_iran_planes()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        notams_future = executor.submit(get_all_notams)
+        planes_future = executor.submit(fetch_iran_planes)
+        notam_list = notams_future.result()
+        current_planes = planes_future.result()
     current_count = len(current_planes)
     
     dt_utc = datetime.now(timezone.utc)
@@ -2271,11 +2442,11 @@ def main():
         else: 
             archive_history.append(record)
             
-    save_json(PLANE_HISTORY_FILE, keep_history)
+    save_json(PLANE_HISTORY_FILE, keep_history, compact=True)
     if archive_history:
         existing_archive = load_json(PLANE_ARCHIVE_FILE, [])
         existing_archive.extend(archive_history)
-        save_json(PLANE_ARCHIVE_FILE, existing_archive)
+        save_json(PLANE_ARCHIVE_FILE, existing_archive, compact=True)
         
     two_weeks_ago = current_timestamp - 1209600 
     history_2weeks = [r for r in keep_history if r.get("timestamp", 0) >= two_weeks_ago]
@@ -2316,92 +2487,113 @@ def main():
 
     current_raw_dict, current_decoded_dict, current_ai_dict = {}, {}, {}
     new_count = 0
-    new_ai_buffer = []
+    new_ai_buffer = set()
+    outbox = []
 
     for notam in notam_list:
         notam_id = notam.get("notamNumber")
-        icao_id = notam.get("icaoId")
-        if not notam_id: 
+        icao_id = notam.get("icaoId") or notam.get("facilityDesignator")
+        if not notam_id or not icao_id:
+            print(f"Skipping NOTAM without a number or location: {notam_id or (notam.get('icaoMessage') or '')[:40]!r}")
             continue
         full_id = f"{icao_id} {notam_id}"
+        notam = {field: notam[field] for field in RAW_NOTAM_FIELDS if field in notam}
         notam["last_seen_utc"] = current_time_utc_str
         current_raw_dict[full_id] = notam
-        if full_id in active_notams_decoded and "error" not in active_notams_decoded[full_id]:
-            current_decoded_dict[full_id] = active_notams_decoded[full_id]
-        if full_id in active_notams_ai and "error" not in active_notams_ai[full_id]:
-            current_ai_dict[full_id] = active_notams_ai[full_id]
-
-    for buf_id in list(set(ai_buffer)):
-        if buf_id in current_raw_dict and buf_id not in current_ai_dict:
-            raw_text = current_raw_dict[buf_id].get("icaoMessage", "")
-            notam_id = current_raw_dict[buf_id].get("notamNumber")
-            ai_data = get_ai_explanation(raw_text)
-            if ai_data and "highest_level" in ai_data:
-                ai_data["last_seen_utc"] = current_time_utc_str
-                current_ai_dict[buf_id] = ai_data
-                lvl = ai_data.get("highest_level", "Third Level")
-                ai_explanation = ai_data.get("explanation", "")
-                notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links = extract_notam_details(raw_text, current_decoded_dict.get(buf_id, {}), notam_id)
-                msg = format_telegram_message(notam_id, notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links, lvl, ai_explanation, raw_text, is_update=True)
-                send_telegram(msg)
-            else:
-                new_ai_buffer.append(buf_id)
-
-    for full_id, notam in current_raw_dict.items():
-        if full_id not in current_decoded_dict:
-            raw_text = notam.get("icaoMessage", "")
-            decoded_obj = decode_notam(raw_text)
-            if decoded_obj:
-                decoded_obj["last_seen_utc"] = current_time_utc_str
-                current_decoded_dict[full_id] = decoded_obj
-
-        if full_id not in seen_ids:
-            raw_text = notam.get("icaoMessage", "")
-            notam_id = notam.get("notamNumber")
-            internal_translation = translate_e_section(raw_text)
-            ai_data = get_ai_explanation(raw_text)
-            if ai_data and "highest_level" in ai_data:
-                ai_data["last_seen_utc"] = current_time_utc_str
-                current_ai_dict[full_id] = ai_data
-                lvl = ai_data.get("highest_level", "Third Level")
-                ai_explanation = ai_data.get("explanation", internal_translation)
-            else:
-                new_ai_buffer.append(full_id)
-                lvl = "Pending"
-                ai_explanation = f"{internal_translation}\n\n*(Will automatically update when AI is available)*"
-
-            notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links = extract_notam_details(raw_text, current_decoded_dict.get(full_id, {}), notam_id)
-            msg = format_telegram_message(notam_id, notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links, lvl, ai_explanation, raw_text, is_update=False)
-            send_telegram(msg)
-            seen_ids[full_id] = current_time_utc_str
-            new_count += 1
-
-    removed_count = 0
-    newly_expired_raw, newly_expired_decoded, newly_expired_ai = {}, {}, {}
-    for old_id, old_data in active_notams_raw.items():
-        if old_id not in current_raw_dict:
-            old_data["archived_utc"] = current_time_utc_str
-            newly_expired_raw[old_id] = old_data
-            if old_id in active_notams_decoded:
-                dec_data = active_notams_decoded[old_id]
-                dec_data["archived_utc"] = current_time_utc_str
-                newly_expired_decoded[old_id] = dec_data
-            if old_id in active_notams_ai:
-                ai_ex_data = active_notams_ai[old_id]
-                ai_ex_data["archived_utc"] = current_time_utc_str
-                newly_expired_ai[old_id] = ai_ex_data
-            removed_count += 1
+        if (cached_decoded := active_notams_decoded.get(full_id)) and "error" not in cached_decoded:
+            digest = raw_text_digest(notam.get("icaoMessage", ""))
+            if cached_decoded.setdefault("_raw_hash", digest) == digest:
+                current_decoded_dict[full_id] = cached_decoded
+        if (cached_ai := active_notams_ai.get(full_id)) and "error" not in cached_ai:
+            current_ai_dict[full_id] = cached_ai
+
+    retry_ids = [buf_id for buf_id in ai_buffer if buf_id in seen_ids and buf_id in current_raw_dict and (buf_id not in current_ai_dict or current_ai_dict[buf_id].get("_update_pending"))]
+    retry_request_ids = [buf_id for buf_id in retry_ids if buf_id not in current_ai_dict]
+    retry_ai_results = dict(zip(retry_request_ids, get_ai_explanations([current_raw_dict[buf_id].get("icaoMessage", "") for buf_id in retry_request_ids])))
+    for buf_id in retry_ids:
+        ai_data = current_ai_dict.get(buf_id) or retry_ai_results.get(buf_id)
+        buf_notam = current_raw_dict[buf_id]
+        raw_text = buf_notam.get("icaoMessage", "")
+        notam_id = buf_notam.get("notamNumber")
+        if ai_data and "highest_level" in ai_data:
+            ai_data.pop("_update_pending", None)
+            ai_data["last_seen_utc"] = current_time_utc_str
+            current_ai_dict[buf_id] = ai_data
+            lvl = ai_data.get("highest_level", "Third Level")
+            ai_explanation = ai_data.get("explanation", "")
+            notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links = extract_notam_details(raw_text, current_decoded_dict.get(buf_id, {}), notam_id, dt_utc)
+            msg = format_telegram_message(notam_id, notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links, lvl, ai_explanation, raw_text, is_update=True)
+            outbox.append((buf_id, msg, True))
+        else:
+            new_ai_buffer.add(buf_id)
+
+    pending_decodes = [(full_id, notam.get("icaoMessage", "")) for full_id, notam in current_raw_dict.items() if full_id not in current_decoded_dict]
+    text_cache = {obj["_raw_hash"]: obj for obj in (*expired_notams_decoded.values(), *active_notams_decoded.values()) if "_raw_hash" in obj and "error" not in obj} if pending_decodes else {}
+    decoded_results, to_decode = [], []
+    for full_id, raw_text in pending_decodes:
+        digest = raw_text_digest(raw_text)
+        if cached_decoded := text_cache.get(digest): decoded_results.append((full_id, digest, {k: v for k, v in cached_decoded.items() if k != "archived_utc"}))
+        else: to_decode.append((full_id, digest, raw_text))
+    decoded_batch = decode_notams([raw_text for _, _, raw_text in to_decode])
+    decoded_results += [(full_id, digest, decoded_obj) for (full_id, digest, _), decoded_obj in zip(to_decode, decoded_batch)]
+    for full_id, digest, decoded_obj in decoded_results:
+        if decoded_obj:
+            decoded_obj["last_seen_utc"] = current_time_utc_str
+            decoded_obj["_raw_hash"] = digest
+            current_decoded_dict[full_id] = decoded_obj
+    stop_decoder()
+
+    new_ids = [full_id for full_id in current_raw_dict if full_id not in seen_ids]
+    ai_request_ids = [full_id for full_id in new_ids if full_id not in current_ai_dict]
+    new_ai_results = dict(zip(ai_request_ids, get_ai_explanations([current_raw_dict[full_id].get("icaoMessage", "") for full_id in ai_request_ids])))
+    for full_id in new_ids:
+        ai_data = current_ai_dict.get(full_id) or new_ai_results.get(full_id)
+        notam = current_raw_dict[full_id]
+        raw_text = notam.get("icaoMessage", "")
+        notam_id = notam.get("notamNumber")
+        internal_translation = translate_e_section(raw_text)
+        if ai_data and "highest_level" in ai_data:
+            ai_data["last_seen_utc"] = current_time_utc_str
+            current_ai_dict[full_id] = ai_data
+            lvl = ai_data.get("highest_level", "Third Level")
+            ai_explanation = ai_data.get("explanation", internal_translation)
+        else:
+            new_ai_buffer.add(full_id)
+            lvl = "Pending"
+            ai_explanation = f"{internal_translation}\n\n*(Will automatically update when AI is available)*"
+
+        notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links = extract_notam_details(raw_text, current_decoded_dict.get(full_id, {}), notam_id, dt_utc)
+        msg = format_telegram_message(notam_id, notam_type, valid_from_str, valid_to_str, subject_text, condition_text, traffic_list, map_links, lvl, ai_explanation, raw_text, is_update=False)
+        outbox.append((full_id, msg, False))
+        new_count += 1
+
+    # Ids are marked seen once Telegram accepted or permanently refused the alert
+    packed = pack_telegram_messages(outbox)
+    for items, text in packed:
+        for (full_id, _, is_update), done in zip(items, send_telegram_pack(items, text)):
+            if done:
+                if not is_update: seen_ids[full_id] = current_time_utc_str
+            elif is_update:
+                new_ai_buffer.add(full_id)
+                current_ai_dict[full_id]["_update_pending"] = True
+
+    expired_ids = active_notams_raw.keys() - current_raw_dict.keys()
+    removed_count = len(expired_ids)
+    for old_id in expired_ids:
+        old_data = active_notams_raw[old_id]
+        old_data["archived_utc"] = current_time_utc_str
+        expired_notams_raw.setdefault(old_id, old_data)
+        if (dec_data := active_notams_decoded.get(old_id)) is not None:
+            dec_data["archived_utc"] = current_time_utc_str
+            expired_notams_decoded.setdefault(old_id, dec_data)
+        if (ai_ex_data := active_notams_ai.get(old_id)) is not None:
+            ai_ex_data["archived_utc"] = current_time_utc_str
+            expired_notams_ai.setdefault(old_id, ai_ex_data)
             
-    expired_notams_raw = {**newly_expired_raw, **expired_notams_raw}
-    expired_notams_decoded = {**newly_expired_decoded, **expired_notams_decoded}
-    expired_notams_ai = {**newly_expired_ai, **expired_notams_ai}
-
-    new_state = {}
-    for cid in current_raw_dict.keys(): 
-        new_state[cid] = seen_ids.get(cid, current_time_utc_str)
+    new_state = {cid: seen_ids[cid] for cid in current_raw_dict if cid in seen_ids}
 
     save_json(STATE_FILE, new_state)
-    save_json(AI_BUFFER_FILE, new_ai_buffer)
+    save_json(AI_BUFFER_FILE, sorted(new_ai_buffer))
     save_json(ACTIVE_RAW_FILE, current_raw_dict)
     save_json(ACTIVE_DECODED_FILE, current_decoded_dict)
     save_json(ACTIVE_AI_FILE, current_ai_dict)
@@ -2410,8 +2602,7 @@ def main():
     save_json(EXPIRED_AI_FILE, expired_notams_ai)
 
     run_record = {"time_utc": current_time_utc_str, "total_active": len(current_raw_dict), "new_added": new_count, "removed": removed_count, "buffered_ai": len(new_ai_buffer)}
-    run_history.insert(0, run_record)
-    save_json(HISTORY_FILE, run_history[:250])
+    append_run_history(run_record)
 
 if __name__ == "__main__":
     main()
@@ -1,17 +1,26 @@
 const notamDecoder = require('./notam-decoder.js');
-const fs = require('fs');
+const readline = require('readline');
 
-const inputPath = process.argv[2];
-if (!inputPath) {
-    console.error(JSON.stringify({error: "No input file provided"}));
-    process.exit(1);
-}
+// Keep the decoder's debug logging off stdout, which carries the responses
+console.log = console.warn;
 
-try {
-    const rawNotam = fs.readFileSync(inputPath, 'utf8');
-    const decoded = notamDecoder.decode(rawNotam);
-    console.log(JSON.stringify(decoded));
-} catch (e) {
-    console.error(JSON.stringify({error: e.toString()}));
-    process.exit(1);
-}
+const decodeOne = (rawNotam) => {
+    try {
+        return notamDecoder.decode(rawNotam) || {error: "Empty result"};
+    } catch (e) {
+        return {error: e.toString()};
+    }
+};
+
+const rl = readline.createInterface({ input: process.stdin });
+
+rl.on('line', (line) => {
+    let decoded;
+    try {
+        const request = JSON.parse(line);
+        decoded = Array.isArray(request) ? request.map(decodeOne) : decodeOne(request);
+    } catch (e) {
+        decoded = {error: e.toString()};
+    }
+    process.stdout.write(JSON.stringify(decoded) + "\n");
+});